@@ -1,8 +1,5 @@
-import gzip
-import io
 import os
 import sqlite3
-import requests
 from flask import Flask, jsonify, request
 import pandas as pd
 import json
@@ -10,7 +7,12 @@ from datetime import datetime, timedelta
 from dateutil import parser
 from sp_api.api import ReportsV2
 from sp_api.base import Marketplaces
-from time import sleep
+from time import sleep, monotonic
+from report_download import (add_document_hash_column, get_report_document, iter_normalized_batches,
+                             record_prefix, save_report_document, store_document)
+from report_polling import (create_report_timings_table, get_expected_duration, payload_duration, poll_delays,
+                            save_report_timing, span_bucket)
+import tempfile
 
 app = Flask(__name__)
 
@@ -37,9 +39,12 @@ def init_db():
             end_time TEXT,
             record_path TEXT,
             report_id TEXT,
+            document_hash TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    add_document_hash_column(c)
+    create_report_timings_table(c)
     conn.commit()
     conn.close()
 
@@ -97,31 +102,95 @@ def request_report(reports_api, report_type, start_time, end_time, asingranulari
     return response.payload['reportId']
 
 
-def check_report_status(reports_api, report_id):
-    status = 'IN_QUEUE'
-    while status in ['IN_QUEUE', 'IN_PROGRESS']:
-        sleep(10)
+def check_report_status(reports_api, report_id, delays):
+    for delay in delays:
+        sleep(delay)
         report_response = reports_api.get_report(report_id)
         status = report_response.payload['processingStatus']
         print(f"Report status: {status}")
         if status == 'DONE':
-            return report_response.payload['reportDocumentId']
-    return None
+            return report_response.payload
+        if status not in ['IN_QUEUE', 'IN_PROGRESS']:
+            return None
 
 
 def download_report(reports_api, document_id):
     document_response = reports_api.get_report_document(document_id)
     download_url = document_response.payload['url']
-    content_type = document_response.payload['compressionAlgorithm']
-    report_data = requests.get(download_url).content
-    if content_type == 'GZIP':
-        buf = io.BytesIO(report_data)
-        with gzip.open(buf, 'rt') as f:
-            return f.read()
-    return report_data.decode('utf-8')
+    content_type = document_response.payload.get('compressionAlgorithm')
+    # Streamed to a spool file and stored under its content hash, see report_download
+    return store_document(download_url, document_id, compressed=content_type == 'GZIP')
 
 
-def request_and_download_report(report_type, marketplace, start_time, end_time, record_path, save_path):
+def normalize_document(document_hash, record_path):
+    # Normalized rows are stored next to the document, keyed by the record path, so each is parsed only once.
+    # Shares its batches and normalized file with the API, see iter_normalized_batches
+    batches = iter_normalized_batches(document_hash, json.dumps(record_path), record_prefix(record_path),
+                                      lambda records: pd.json_normalize(records).to_json(orient='records'))
+    return [row for batch in batches for row in batch]
+
+
+# Columns that identify a row, used to drop duplicates when overlapping windows land in the same partition
+natural_key_columns = ['date', 'parentAsin', 'childAsin', 'sku']
+
+
+def to_typed_frame(df, marketplace_str, start_time, end_time):
+    df = df.copy()
+    df['dataStartTime'] = pd.to_datetime(start_time)
+    df['dataEndTime'] = pd.to_datetime(end_time)
+    if 'date' in df.columns:
+        df['date'] = pd.to_datetime(df['date'])
+        partition_date = df['date']
+    else:
+        partition_date = df['dataStartTime']
+    df = df.convert_dtypes()
+    df['marketplace'] = marketplace_str
+    df['year'] = partition_date.dt.year
+    df['month'] = partition_date.dt.month
+    return df
+
+
+def replace_partition(partition_df, partition_dir, key):
+    # Merge with the existing partition file, then swap the new file in atomically
+    os.makedirs(partition_dir, exist_ok=True)
+    part_path = os.path.join(partition_dir, 'part-0.parquet')
+    if os.path.exists(part_path):
+        partition_df = pd.concat([pd.read_parquet(part_path), partition_df], ignore_index=True)
+    partition_df = partition_df.drop_duplicates(subset=key, keep='last')
+    sort_columns = [column for column in ['date', 'dataStartTime'] if column in partition_df.columns]
+    partition_df = partition_df.sort_values(sort_columns).reset_index(drop=True)
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.parquet.tmp', dir=partition_dir)
+    os.close(fd)
+    try:
+        partition_df.to_parquet(tmp_path, engine='pyarrow', compression='zstd', index=False)
+        os.replace(tmp_path, part_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save_partitioned_parquet(df, dataset_path, marketplace_str, start_time, end_time):
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ValueError("Parquet output requires pyarrow. Install it with `pip install pyarrow`.")
+
+    df = to_typed_frame(df, marketplace_str, start_time, end_time)
+    # Windows without a date column are keyed by their data range as well
+    key = [column for column in natural_key_columns if column in df.columns]
+    if 'date' not in key:
+        key = ['dataStartTime', 'dataEndTime'] + key
+
+    for (marketplace_value, year, month), partition_df in df.groupby(['marketplace', 'year', 'month']):
+        partition_dir = os.path.join(dataset_path, f'marketplace={marketplace_value}', f'year={year}',
+                                     f'month={month}')
+        replace_partition(partition_df.drop(columns=['marketplace', 'year', 'month']), partition_dir, key)
+        print(f"Partition saved to {partition_dir}")
+
+
+def request_and_download_report(report_type, marketplace, start_time, end_time, record_path, save_path,
+                                output_format='csv'):
     try:
         credentials = get_credentials()
     except ValueError as e:
@@ -133,18 +202,38 @@ def request_and_download_report(report_type, marketplace, start_time, end_time,
     if cached_report_id:
         print(f"Using cached report ID: {cached_report_id}")
         report_id = cached_report_id
+        # A report that was downloaded before is served from its stored document without polling Amazon
+        document_hash = get_report_document('reports_cache.db', report_id)
     else:
         reports_api = ReportsV2(credentials=credentials, marketplace=marketplace)
         report_id = request_report(reports_api, report_type, start_time, end_time)
+        requested_at = monotonic()
         save_report_cache(report_type, marketplace_str, start_time, end_time, record_path, report_id)
         print(f"Created new report ID: {report_id}")
+        document_hash = None
+
+    if not document_hash:
+        # Poll around the time similar reports took to complete; cached reports are checked right away
+        span_days = span_bucket(start_time, end_time)
+        expected_duration = get_expected_duration('reports_cache.db', report_type, 'DAY', span_days, marketplace_str)
+        delays = poll_delays(expected_duration, check_now=bool(cached_report_id))
 
-    reports_api = ReportsV2(credentials=credentials, marketplace=marketplace)
-    document_id = check_report_status(reports_api, report_id)
-    if document_id:
-        content = download_report(reports_api, document_id)
-        data = json.loads(content)
-        df = pd.json_normalize(data, record_path=record_path)
+        reports_api = ReportsV2(credentials=credentials, marketplace=marketplace)
+        report = check_report_status(reports_api, report_id, delays)
+        if not report:
+            return None
+        if not cached_report_id:
+            duration = payload_duration(report, 'createdTime', 'processingEndTime')
+            if duration is None:
+                duration = monotonic() - requested_at
+            save_report_timing('reports_cache.db', report_type, 'DAY', span_days, marketplace_str, duration)
+        document_hash = download_report(reports_api, report['reportDocumentId'])
+        save_report_document('reports_cache.db', report_id, document_hash)
+
+    df = pd.DataFrame(normalize_document(document_hash, record_path))
+    if output_format == 'parquet':
+        save_partitioned_parquet(df, save_path, marketplace_str, start_time, end_time)
+    else:
         df.to_csv(save_path, index=False)  # Save the data to CSV file
         print(f"Report saved to {save_path}")
 
@@ -159,23 +248,36 @@ def get_monthly_reports():
     report_type = request.args.get('reportType', 'GET_SALES_AND_TRAFFIC_REPORT')
     country_code = request.args.get('countryCode', 'FR').upper()
     marketplace = marketplaces.get(country_code, Marketplaces.FR)  # Default to FR if not found
+    # csv: one file per window in reports/, parquet: Hive-style dataset in reports/dataset/
+    output_format = request.args.get('outputFormat', 'csv').lower()
+    if output_format not in ('csv', 'parquet'):
+        return jsonify({'status': 'error', 'message': 'outputFormat must be csv or parquet'}), 400
 
     start_date = datetime(2024, 1, 1)  # Starting date: June 2021
     end_date = datetime(2024, 6, 30)  # Ending date: June 2024
     current_date = start_date
 
     while current_date <= end_date:
-        next_date = current_date + timedelta(days=30)  # Assuming roughly 30 days in a month
+        if output_format == 'parquet':
+            # Calendar months, so every window holds exactly one month of data and lands in that month's partition
+            next_date = (current_date.replace(day=28) + timedelta(days=4)).replace(day=1)
+            end_time = (next_date - timedelta(seconds=1)).isoformat()
+        else:
+            next_date = current_date + timedelta(days=30)  # Assuming roughly 30 days in a month
+            end_time = next_date.isoformat()
         start_time = current_date.isoformat()
-        end_time = next_date.isoformat()
 
         year_month = current_date.strftime('%Y_%m')
-        save_path = f'reports/{year_month}.csv'  # Save path with format Year/Month
+        if output_format == 'parquet':
+            save_path = 'reports/dataset'  # Partitioned by marketplace=/year=/month=
+        else:
+            save_path = f'reports/{year_month}.csv'  # Save path with format Year/Month
         print("Time range:{0} & {1}".format(start_time, end_time))
         record_path = request.args.get('recordPath', ['salesAndTrafficByAsin'])
 
         try:
-            request_and_download_report(report_type, marketplace, start_time, end_time, record_path, save_path)
+            request_and_download_report(report_type, marketplace, start_time, end_time, record_path, save_path,
+                                        output_format)
         except Exception as e:
             print(f"Error fetching report for {year_month}: {e}")
 
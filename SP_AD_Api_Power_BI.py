@@ -1,7 +1,7 @@
 # Some logs are prints and have been commented out for now, please remove comment if needed
+# pandas, ad_api and APScheduler are heavy to import, so they are imported inside the functions that use them.
+# This keeps worker boot and reloads fast; call create_app() (or init_db()) before serving requests.
 
-import gzip
-import io
 import os
 import sqlite3
 import requests
@@ -10,18 +10,22 @@ from urllib.parse import urlencode
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from dateutil import parser
-from apscheduler.schedulers.background import BackgroundScheduler
-from ad_api.base import AdvertisingApiException, Marketplaces, MarketplacesIds
-from ad_api.api import Reports
 import time
 import json
-import pandas as pd
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from report_download import (add_document_hash_column, get_report_document, iter_normalized_batches,
+                             save_report_document, store_document)
+from report_profiling import profile_request, profiling_blueprint, profiling_requested
+from report_streaming import RESPONSE_FORMATS, report_response
+from report_polling import (create_report_timings_table, get_expected_duration, payload_duration, poll_delays,
+                            save_report_timing, span_bucket)
 
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
+app.register_blueprint(profiling_blueprint)
 
 CLIENT_ID = os.getenv('AD_API_CLIENT_ID')
 CLIENT_SECRET = os.getenv('AD_API_CLIENT_SECRET')
@@ -29,17 +33,44 @@ REDIRECT_URI = "http://127.0.0.1:5000/amazonlogin"
 SCOPE = "advertising::campaign_management"
 AUTHORIZATION_URL = "https://eu.account.amazon.com/ap/oa"
 TOKEN_URL = "https://api.amazon.co.uk/auth/o2/token"
-
-# Mapping of country codes to Marketplaces
-marketplaces = {
-    'AE': Marketplaces.AE, 'BE': Marketplaces.BE, 'DE': Marketplaces.DE, 'PL': Marketplaces.PL,
-    'EG': Marketplaces.EG, 'ES': Marketplaces.ES, 'FR': Marketplaces.FR, 'GB': Marketplaces.GB,
-    'IN': Marketplaces.IN, 'IT': Marketplaces.IT, 'NL': Marketplaces.NL, 'SA': Marketplaces.SA,
-    'SE': Marketplaces.SE, 'TR': Marketplaces.TR, 'UK': Marketplaces.UK,
-    'AU': Marketplaces.AU, 'JP': Marketplaces.JP, 'SG': Marketplaces.SG, 'US': Marketplaces.US,
-    'BR': Marketplaces.BR, 'CA': Marketplaces.CA, 'MX': Marketplaces.MX
+MAX_REPORT_DAYS = 31  # Longest date range the Ads API accepts in a single report
+MAX_CHUNK_WORKERS = 4
+
+# Supported Ads report types. Columns exclude the date columns, which depend on the time unit.
+# key_columns identify a product row, the other columns are metrics summed when SUMMARY chunks are merged.
+# harmonized_columns renames columns to shared names when several report types are combined in one table.
+report_types = {
+    'spAdvertisedProduct': {
+        'ad_product': 'SPONSORED_PRODUCTS',
+        'retention_days': 90,
+        'columns': ["impressions", "clicks", "cost", "advertisedAsin", "unitsSoldSameSku7d", "unitsSoldOtherSku7d",
+                    "sales7d", "advertisedSku"],
+        'key_columns': ["advertisedAsin", "advertisedSku"],
+        'harmonized_columns': {'advertisedAsin': 'asin', 'advertisedSku': 'sku', 'sales7d': 'sales'},
+    },
+    'sdAdvertisedProduct': {
+        'ad_product': 'SPONSORED_DISPLAY',
+        'retention_days': 65,
+        'columns': ["promotedSku", "promotedAsin", "impressions", "clicks", "cost", "unitsSold", "sales"],
+        'key_columns': ["promotedAsin", "promotedSku"],
+        'harmonized_columns': {'promotedAsin': 'asin', 'promotedSku': 'sku'},
+    },
 }
 
+# Country codes supported by ad_api Marketplaces
+marketplace_codes = (
+    'AE', 'BE', 'DE', 'PL', 'EG', 'ES', 'FR', 'GB', 'IN', 'IT', 'NL', 'SA',
+    'SE', 'TR', 'UK', 'AU', 'JP', 'SG', 'US', 'BR', 'CA', 'MX'
+)
+
+
+def get_marketplace(country_code):
+    if country_code not in marketplace_codes:
+        return None
+    from ad_api.base import Marketplaces
+
+    return Marketplaces[country_code]
+
 
 # Initialize SQLite database
 def init_db():
@@ -74,9 +105,11 @@ def init_db():
             time_unit TEXT,
             marketplace TEXT,
             report_id TEXT,
+            document_hash TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    add_document_hash_column(c)
     c.execute('''
         CREATE TABLE IF NOT EXISTS request_queue (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -91,11 +124,15 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    create_report_timings_table(c)
     conn.commit()
     conn.close()
 
 
-init_db()
+def create_app():
+    # Explicit initialization, e.g. `gunicorn "SP_AD_Api_Power_BI:create_app()"`
+    init_db()
+    return app
 
 
 def save_tokens(access_token, refresh_token):
@@ -247,8 +284,13 @@ def process_request_queue():
                 try:
                     request_id, profile_id, start_date, end_date, report_type, time_unit, marketplace, user_ip = request_data[0:8]
                     update_request_status(request_id, 'processing')
-                    report_data = request_and_download_report(profile_id, start_date, end_date,
-                                                              marketplaces[marketplace], report_type, time_unit)
+                    # Queue jobs have no request headers, they are profiled while the admin switch is on
+                    with profile_request(f'queue-{request_id}', profiling_requested()):
+                        # The batches are consumed so the document is normalized and stored here, not by the first
+                        # response that reads it
+                        for _ in request_and_download_report(profile_id, start_date, end_date,
+                                                             get_marketplace(marketplace), report_type, time_unit):
+                            pass
                     update_request_status(request_id, 'completed')
                 except Exception as e:
                     print(f"Error processing request {request_data}: {e}")
@@ -317,6 +359,62 @@ def get_profiles():
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
+def split_date_range(start_date, end_date):
+    # Long ranges are split into calendar months, so overlapping future ranges reuse the same cached chunk reports
+    start_date_obj = parser.parse(start_date).date()
+    end_date_obj = parser.parse(end_date).date()
+    if (end_date_obj - start_date_obj).days < MAX_REPORT_DAYS:
+        return [(start_date_obj.isoformat(), end_date_obj.isoformat())]
+
+    chunks = []
+    chunk_start = start_date_obj
+    while chunk_start <= end_date_obj:
+        month_end = (chunk_start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        chunk_end = min(month_end, end_date_obj)
+        chunks.append((chunk_start.isoformat(), chunk_end.isoformat()))
+        chunk_start = chunk_end + timedelta(days=1)
+    return chunks
+
+
+def get_report_columns(report_type, time_unit):
+    if report_type not in report_types:
+        raise ValueError("Unsupported report type")
+    date_columns = ["startDate", "endDate"] if time_unit == "SUMMARY" else ["date"]
+    return date_columns + report_types[report_type]['columns']
+
+
+def check_retention(report_type, start_date, end_date):
+    # Ensure the date range is within the retention period of the report type
+    retention_days = report_types[report_type]['retention_days']
+    today = datetime.utcnow()
+    if (today - parser.parse(start_date)).days > retention_days or (today - parser.parse(end_date)).days > retention_days:
+        raise ValueError(f"Date range exceeds the maximum retention period of {retention_days} days.")
+
+
+def split_report_types(report_type):
+    # A comma separated list of report types is returned as one combined table. A report type listed twice is
+    # requested once, in the order it was first listed
+    return list(dict.fromkeys(name.strip() for name in report_type.split(',')))
+
+
+def combined_columns(combined_report_types, time_unit):
+    # The shared column names of a combined table, from the report type registry
+    all_columns = {'adProduct': None}
+    for report_type in combined_report_types:
+        harmonized_columns = report_types[report_type]['harmonized_columns']
+        all_columns.update(dict.fromkeys(harmonized_columns.get(column, column)
+                                         for column in get_report_columns(report_type, time_unit)))
+    return list(all_columns)
+
+
+def report_output_columns(report_type, time_unit):
+    # Columns of the rows request_and_download_report returns, used as the CSV header
+    report_type_names = split_report_types(report_type)
+    if len(report_type_names) == 1:
+        return get_report_columns(report_type_names[0], time_unit)
+    return combined_columns(report_type_names, time_unit)
+
+
 def request_and_download_report(profile_id, start_date, end_date, marketplace, report_type="spAdvertisedProduct",
                                 time_unit="SUMMARY"):
     try:
@@ -329,43 +427,113 @@ def request_and_download_report(profile_id, start_date, end_date, marketplace, r
     """print(
         f"Requesting report for profile_id={profile_id}, start_date={start_date}, end_date={end_date}, marketplace={marketplace}, report_type={report_type}, time_unit={time_unit}")"""
 
-    # Ensure the date range is within the last 90 days
-    today = datetime.utcnow()
-    start_date_obj = parser.parse(start_date)
-    end_date_obj = parser.parse(end_date)
-
-    if report_type == "spAdvertisedProduct":
-        if (today - start_date_obj).days > 90 or (today - end_date_obj).days > 90:
-            raise ValueError("Date range exceeds the maximum retention period of 90 days.")
-        if time_unit == "SUMMARY":
-            columns = ["startDate", "endDate", "impressions", "clicks", "cost", "advertisedAsin",
-                       "unitsSoldSameSku7d", "unitsSoldOtherSku7d",
-                       "sales7d", "advertisedSku"]
-        else:
-            columns = ["date", "impressions", "clicks", "cost", "advertisedAsin",
-                       "unitsSoldSameSku7d", "unitsSoldOtherSku7d",
-                       "sales7d", "advertisedSku"]
-    elif report_type == "sdAdvertisedProduct":
-        if (today - start_date_obj).days > 65 or (today - end_date_obj).days > 65:
-            raise ValueError("Date range exceeds the maximum retention period of 65 days.")
-        if time_unit == "SUMMARY":
-            columns = [
-                "startDate", "endDate", "promotedSku", "promotedAsin", "impressions", "clicks", "cost", "unitsSold",
-                "sales",
-            ]
-        else:
-            columns = [
-                "date", "promotedSku", "promotedAsin", "impressions", "clicks", "cost", "unitsSold",
-                "sales",
-            ]
+    # Returns the report rows as a generator of batches. The reports are requested and downloaded here, the
+    # documents are normalized as the batches are consumed.
+    report_type_names = split_report_types(report_type)
+    # Validate every report type before submitting anything
+    for name in report_type_names:
+        get_report_columns(name, time_unit)
+        check_retention(name, start_date, end_date)
+
+    chunks = split_date_range(start_date, end_date)
+    document_hashes = download_report_documents(credentials, profile_id, chunks, marketplace, report_type_names,
+                                                time_unit)
+    if len(report_type_names) == 1:
+        name = report_type_names[0]
+        return report_type_batches(name, time_unit, chunks, document_hashes[name])
+    return combined_report_batches(report_type_names, time_unit, chunks, document_hashes)
+
+
+def download_report_documents(credentials, profile_id, chunks, marketplace, report_type_names, time_unit):
+    # Every report type and chunk is its own cached report, they are requested concurrently.
+    # Returns the stored document hashes of each report type in chunk order
+    jobs = [(name, chunk_start, chunk_end) for name in report_type_names for chunk_start, chunk_end in chunks]
+    if len(jobs) == 1:
+        name, chunk_start, chunk_end = jobs[0]
+        return {name: [download_report_chunk(credentials, profile_id, chunk_start, chunk_end, marketplace, name,
+                                             time_unit, get_report_columns(name, time_unit))]}
+
+    if len(chunks) > 1:
+        print(f"Splitting {chunks[0][0]} - {chunks[-1][1]} into {len(chunks)} reports")
+    with ThreadPoolExecutor(max_workers=min(len(jobs), MAX_CHUNK_WORKERS * len(report_type_names))) as executor:
+        futures = [executor.submit(download_report_chunk, credentials, profile_id, chunk_start, chunk_end,
+                                   marketplace, name, time_unit, get_report_columns(name, time_unit))
+                   for name, chunk_start, chunk_end in jobs]
+        results = [future.result() for future in futures]
+    return {name: results[i * len(chunks):(i + 1) * len(chunks)] for i, name in enumerate(report_type_names)}
+
+
+def report_type_batches(report_type, time_unit, chunks, document_hashes):
+    if len(document_hashes) == 1:
+        yield from normalize_document(document_hashes[0])
+    elif time_unit == "SUMMARY":
+        # Adding up the chunks needs all of their rows
+        json_data = [row for document_hash in document_hashes for batch in normalize_document(document_hash)
+                     for row in batch]
+        yield merge_summary_chunks(json_data, report_type, chunks[0][0], chunks[-1][1])
     else:
-        raise ValueError("Unsupported report type")
+        # Chunks are in date order, so sorting the rows of each chunk by date sorts the whole range
+        for document_hash in document_hashes:
+            json_data = [row for batch in normalize_document(document_hash) for row in batch]
+            json_data.sort(key=lambda row: row.get('date') or '')
+            yield json_data
+
+
+def combined_report_batches(combined_report_types, time_unit, chunks, document_hashes):
+    # Rename to the shared column names and fill the columns a report type doesn't have, so every row has the same
+    # keys. The columns come from the report type registry, so the rows can be streamed one report type at a time
+    all_columns = combined_columns(combined_report_types, time_unit)
+
+    for report_type in combined_report_types:
+        harmonized_columns = report_types[report_type]['harmonized_columns']
+        ad_product = report_types[report_type]['ad_product']
+        for batch in report_type_batches(report_type, time_unit, chunks, document_hashes[report_type]):
+            rows = []
+            for row in batch:
+                row = {harmonized_columns.get(column, column): value for column, value in row.items()}
+                row['adProduct'] = ad_product
+                rows.append({column: row.get(column) for column in all_columns})
+            yield rows
+
+
+def merge_summary_chunks(json_data, report_type, start_date, end_date):
+    import pandas as pd
+
+    # Each chunk summarizes its own month, add them up into one row per product over the requested range
+    if not json_data:
+        return json_data
+    df = pd.DataFrame(json_data).drop(columns=["startDate", "endDate"], errors='ignore')
+    key_columns = [column for column in report_types[report_type]['key_columns'] if column in df.columns]
+    df = df.groupby(key_columns, as_index=False, dropna=False).sum(numeric_only=True)
+    df.insert(0, "startDate", start_date)
+    df.insert(1, "endDate", end_date)
+    return json.loads(df.to_json(orient='records'))
+
+
+def normalize_document(document_hash):
+    import pandas as pd
+
+    # Normalized rows are stored next to the document, so identical documents are parsed only once.
+    # The document is flattened in batches, see iter_normalized_batches
+    return iter_normalized_batches(document_hash, 'records', 'item',
+                                   lambda records: pd.json_normalize(records).to_json(orient='records'))
+
+
+def download_report_chunk(credentials, profile_id, start_date, end_date, marketplace, report_type, time_unit,
+                          columns):
+    from ad_api.api import Reports
+    from ad_api.base import AdvertisingApiException
 
     # Check if the same request was made before and retrieve the report ID if it exists
     cached_report_id = get_report_cache(profile_id, start_date, end_date, report_type, time_unit, marketplace.name)
     if cached_report_id:
         print(f"Using cached report ID: {cached_report_id}")
         report_id = cached_report_id
+        # A report that was downloaded before is served from its stored document without polling Amazon
+        document_hash = get_report_document('tokens.db', report_id)
+        if document_hash:
+            print(f"Using stored document {document_hash}")
+            return document_hash
         reports = Reports(
             marketplace=marketplace,
             credentials={
@@ -393,7 +561,7 @@ def request_and_download_report(profile_id, start_date, end_date, marketplace, r
             "startDate": start_date,
             "endDate": end_date,
             "configuration": {
-                "adProduct": "SPONSORED_PRODUCTS" if report_type == "spAdvertisedProduct" else "SPONSORED_DISPLAY",
+                "adProduct": report_types[report_type]['ad_product'],
                 "columns": columns,
                 "reportTypeId": report_type,
                 "format": "GZIP_JSON",
@@ -404,40 +572,43 @@ def request_and_download_report(profile_id, start_date, end_date, marketplace, r
 
         report = reports.post_report(body=report_body)
         report_id = report.payload['reportId']
+        requested_at = time.monotonic()
         save_report_cache(profile_id, start_date, end_date, report_type, time_unit, marketplace.name, report_id)
         print(f"Created new report ID: {report_id}")
 
-    # Poll the report status until it is available
+    # Poll the report status until it is available, around the time similar reports took to complete.
+    # Cached reports are checked right away.
+    span_days = span_bucket(start_date, end_date)
+    expected_duration = get_expected_duration('tokens.db', report_type, time_unit, span_days, marketplace.name)
+    delays = poll_delays(expected_duration, check_now=bool(cached_report_id))
     while True:
+        time.sleep(next(delays))
         try:
             report = reports.get_report(reportId=report_id)
             report_status = report.payload['status']
             print(report_status)
             if report_status == 'COMPLETED':
                 print("REPORT STATUS: COMPLETED")
+                if not cached_report_id:
+                    duration = payload_duration(report.payload, 'createdAt', 'updatedAt')
+                    if duration is None:
+                        duration = time.monotonic() - requested_at
+                    save_report_timing('tokens.db', report_type, time_unit, span_days, marketplace.name, duration)
                 break
             elif report_status == 'FAILED':
                 print("REPORT STATUS: FAILED")
-                return jsonify({'status': 'error', 'message': 'Failed to generate report'}), 500
-            time.sleep(10)  # Wait for 10 seconds before checking the status again
+                raise ValueError(f"Failed to generate report {report_id}")
         except AdvertisingApiException as e:
             print(f"Advertising API Exception: {e}")
             if e.code == 429:
                 time.sleep(60)  # Wait for 1 minute if rate limited
             else:
                 raise e
-        time.sleep(10)  # Wait for 10 seconds before checking the status again
 
-    # Download the report
-    download_url = report.payload['url']
-    report_data = requests.get(download_url).content
-    buf = io.BytesIO(report_data)
-    with gzip.open(buf, 'rt') as f:
-        report_content = f.read()
-    report_json = json.loads(report_content)
-    df = pd.json_normalize(report_json)
-    json_data = json.loads(df.to_json(orient='records'))
-    return json_data
+    # Download the report to a spool file and store it under its content hash
+    document_hash = store_document(report.payload['url'], report_id)
+    save_report_document('tokens.db', report_id, document_hash)
+    return document_hash
 
 
 @app.route('/get-ad-report', methods=['GET'])
@@ -450,12 +621,16 @@ def get_ad_report():
         marketplace_str = request.args.get('marketplace')  # No default value
         profile_name = request.args.get('profileName')  # Profile name to filter by
         profile_name = profile_name.replace("%20", " ")
-        marketplace = marketplaces.get(marketplace_str)
+        marketplace = get_marketplace(marketplace_str)
         user_ip = request.remote_addr
 
         if not report_type or not start_date or not end_date or not profile_name or not marketplace:
             return jsonify({'status': 'error', 'message': 'Missing required parameters'}), 400
 
+        output_format = request.args.get('format', 'json').lower()
+        if output_format not in RESPONSE_FORMATS:
+            return jsonify({'status': 'error', 'message': 'format must be json, ndjson or csv'}), 400
+
         # Retrieve profiles from database
         profiles = get_profiles_from_db()
         profile_id = None
@@ -490,16 +665,11 @@ def get_ad_report():
                 ''', (request_id,))
                 status = c.fetchone()[0]
                 if status == 'completed':
-                    c.execute('''
-                        SELECT report_id FROM report_cache
-                        WHERE profile_id = ? AND start_date = ? AND end_date = ? AND report_type = ? AND time_unit = ? AND marketplace = ?
-                        ORDER BY created_at DESC LIMIT 1
-                    ''', (profile_id, start_date, end_date, report_type, time_unit, marketplace_str))
-                    report_id = c.fetchone()[0]
+                    # Long ranges are cached per chunk, request_and_download_report looks them up
                     conn.close()
-                    report_data = request_and_download_report(profile_id, start_date, end_date, marketplace,
-                                                              report_type, time_unit)
-                    return jsonify(report_data)
+                    return report_response('get-ad-report', output_format, request_and_download_report, profile_id,
+                                           start_date, end_date, marketplace, report_type, time_unit,
+                                           columns=report_output_columns(report_type, time_unit))
                 elif status == 'failed':
                     conn.close()
                     return jsonify({'status': 'error', 'message': 'Failed to generate report'}), 500
@@ -511,10 +681,9 @@ def get_ad_report():
         save_request_queue(profile_id, start_date, end_date, report_type, time_unit, marketplace_str, user_ip)
 
         # Process the request
-        report_data = request_and_download_report(profile_id, start_date, end_date, marketplace, report_type, time_unit)
-        return jsonify(report_data)
-    except AdvertisingApiException as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        return report_response('get-ad-report', output_format, request_and_download_report, profile_id, start_date,
+                               end_date, marketplace, report_type, time_unit,
+                               columns=report_output_columns(report_type, time_unit))
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
@@ -528,6 +697,9 @@ def refresh_access_token():
 
 
 if __name__ == '__main__':
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    create_app()
     scheduler = BackgroundScheduler()
     scheduler.add_job(refresh_access_token, 'interval', minutes=55)  # Refresh token every 55 minutes
     scheduler.start()
@@ -1,29 +1,36 @@
-import gzip
-import io
+# pandas and sp_api are heavy to import, so they are imported inside the functions that use them.
+# This keeps worker boot and reloads fast; call create_app() (or init_db()) before serving requests.
+
 import os
 import sqlite3
-import requests
 from flask import Flask, jsonify, request
-import pandas as pd
 import json
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from dateutil import parser
-from sp_api.api import ReportsV2
-from sp_api.base import Marketplaces
-from time import sleep
-import xlwings
+from time import sleep, monotonic
+from report_download import (add_document_hash_column, get_report_document, iter_normalized_batches,
+                             record_prefix, save_report_document, store_document)
+from report_profiling import profiling_blueprint
+from report_streaming import RESPONSE_FORMATS, report_response
+from report_polling import (create_report_timings_table, get_expected_duration, payload_duration, poll_delays,
+                            save_report_timing, span_bucket)
 
 app = Flask(__name__)
+app.register_blueprint(profiling_blueprint)
+
+# Country codes supported by sp_api Marketplaces
+marketplace_codes = (
+    'AE', 'BE', 'DE', 'PL', 'EG', 'ES', 'FR', 'GB', 'IN', 'IT', 'NL', 'SA',
+    'SE', 'TR', 'UK', 'ZA', 'AU', 'JP', 'SG', 'US', 'BR', 'CA', 'MX'
+)
+
 
-# Mapping of country codes to Marketplaces
-marketplaces = {
-    'AE': Marketplaces.AE, 'BE': Marketplaces.BE, 'DE': Marketplaces.DE, 'PL': Marketplaces.PL,
-    'EG': Marketplaces.EG, 'ES': Marketplaces.ES, 'FR': Marketplaces.FR, 'GB': Marketplaces.GB,
-    'IN': Marketplaces.IN, 'IT': Marketplaces.IT, 'NL': Marketplaces.NL, 'SA': Marketplaces.SA,
-    'SE': Marketplaces.SE, 'TR': Marketplaces.TR, 'UK': Marketplaces.UK, 'ZA': Marketplaces.ZA,
-    'AU': Marketplaces.AU, 'JP': Marketplaces.JP, 'SG': Marketplaces.SG, 'US': Marketplaces.US,
-    'BR': Marketplaces.BR, 'CA': Marketplaces.CA, 'MX': Marketplaces.MX
-}
+def get_marketplace(country_code, default='FR'):
+    from sp_api.base import Marketplaces
+
+    if country_code not in marketplace_codes:
+        country_code = default
+    return Marketplaces[country_code]
 
 
 def init_db():
@@ -37,37 +44,77 @@ def init_db():
             start_time TEXT,
             end_time TEXT,
             record_path TEXT,
+            report_options TEXT,
             report_id TEXT,
+            document_hash TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    add_document_hash_column(c)
+    # report_cache tables created before report options were part of the cache key have no report_options column
+    columns = [row[1] for row in c.execute('PRAGMA table_info(report_cache)')]
+    if 'report_options' not in columns:
+        c.execute('ALTER TABLE report_cache ADD COLUMN report_options TEXT')
+    create_report_timings_table(c)
     conn.commit()
     conn.close()
 
 
-init_db()
+def create_app():
+    # Explicit initialization, e.g. `gunicorn "SP_Api_Power_BI:create_app()"`
+    init_db()
+    return app
+
+
+# Report options used for every report. Rows cached before report_options was stored were created with these.
+default_report_options = {'asinGranularity': 'SKU', 'dateGranularity': 'DAY'}
+# Record paths with one row per date. These can be served from a cached report covering a longer range by
+# filtering the rows, other record paths aggregate over the whole range and need an exact match.
+dated_record_paths = {'salesAndTrafficByDate'}
+
+
+def canonical_time(value):
+    # Naive UTC truncated to the day, the report's granularity, so equivalent requests produce identical cache keys
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def canonical_record_path(record_path):
+    # Query strings arrive as 'a,b', defaults as lists
+    if isinstance(record_path, str):
+        record_path = [part.strip() for part in record_path.split(',') if part.strip()]
+    return list(record_path)
 
 
-def get_cached_report_id(report_type, marketplace, start_time, end_time, record_path):
+def canonical_report_options(report_options):
+    return json.dumps(report_options, sort_keys=True)
+
+
+def get_cached_report_id(report_type, marketplace, start_time, end_time, report_options, covering=False):
+    # With covering, any report whose range contains the requested one matches
+    range_condition = 'start_time <= ? AND end_time >= ?' if covering else 'start_time = ? AND end_time = ?'
     conn = sqlite3.connect('reports_cache.db')
     c = conn.cursor()
-    c.execute('''
+    c.execute(f'''
         SELECT report_id FROM report_cache
-        WHERE report_type = ? AND marketplace = ? AND start_time = ? AND end_time = ? AND record_path = ?
+        WHERE report_type = ? AND marketplace = ? AND COALESCE(report_options, ?) = ? AND {range_condition}
         ORDER BY created_at DESC LIMIT 1
-    ''', (report_type, marketplace, start_time, end_time, json.dumps(record_path)))
+    ''', (report_type, marketplace, canonical_report_options(default_report_options),
+          canonical_report_options(report_options), start_time, end_time))
     result = c.fetchone()
     conn.close()
     return result[0] if result else None
 
 
-def save_report_cache(report_type, marketplace, start_time, end_time, record_path, report_id):
+def save_report_cache(report_type, marketplace, start_time, end_time, record_path, report_options, report_id):
     conn = sqlite3.connect('reports_cache.db')
     c = conn.cursor()
     c.execute('''
-        INSERT INTO report_cache (report_type, marketplace, start_time, end_time, record_path, report_id)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (report_type, marketplace, start_time, end_time, json.dumps(record_path), report_id))
+        INSERT INTO report_cache (report_type, marketplace, start_time, end_time, record_path, report_options, report_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (report_type, marketplace, start_time, end_time, json.dumps(record_path),
+          canonical_report_options(report_options), report_id))
     conn.commit()
     conn.close()
 
@@ -97,28 +144,33 @@ def request_report(reports_api, report_type, start_time, end_time, asingranulari
     return response.payload['reportId']
 
 
-def check_report_status(reports_api, report_id):
-    status = 'IN_QUEUE'
-    while status in ['IN_QUEUE', 'IN_PROGRESS']:
-        sleep(10)
+def check_report_status(reports_api, report_id, delays):
+    for delay in delays:
+        sleep(delay)
         report_response = reports_api.get_report(report_id)
         status = report_response.payload['processingStatus']
         print(f"Report status: {status}")
         if status == 'DONE':
-            return report_response.payload['reportDocumentId']
-    return None
+            return report_response.payload
+        if status not in ['IN_QUEUE', 'IN_PROGRESS']:
+            return None
 
 
 def download_report(reports_api, document_id):
     document_response = reports_api.get_report_document(document_id)
     download_url = document_response.payload['url']
-    content_type = document_response.payload['compressionAlgorithm']
-    report_data = requests.get(download_url).content
-    if content_type == 'GZIP':
-        buf = io.BytesIO(report_data)
-        with gzip.open(buf, 'rt') as f:
-            return f.read()
-    return report_data.decode('utf-8')
+    content_type = document_response.payload.get('compressionAlgorithm')
+    # Streamed to a spool file and stored under its content hash, see report_download
+    return store_document(download_url, document_id, compressed=content_type == 'GZIP')
+
+
+def normalize_document(document_hash, record_path):
+    import pandas as pd
+
+    # Normalized rows are stored next to the document, keyed by the record path, so each is parsed only once.
+    # The records under the record path are flattened in batches, see iter_normalized_batches
+    return iter_normalized_batches(document_hash, json.dumps(record_path), record_prefix(record_path),
+                                   lambda records: pd.json_normalize(records).to_json(orient='records'))
 
 
 @app.route('/')
@@ -127,6 +179,9 @@ def home():
 
 
 def request_and_download_report(report_type, marketplace, start_time, end_time, record_path):
+    # Returns the report rows as a generator of batches, or None if the report didn't complete
+    from sp_api.api import ReportsV2
+
     try:
         credentials = get_credentials()
     except ValueError as e:
@@ -134,33 +189,59 @@ def request_and_download_report(report_type, marketplace, start_time, end_time,
         exit(1)  # Or handle more gracefully
 
     marketplace_str = marketplace.name  # Convert Marketplaces enum to string
-    cached_report_id = get_cached_report_id(report_type, marketplace_str, start_time, end_time, record_path)
+    # Dated rows can be cut out of a cached report covering a longer range
+    covering = all(path in dated_record_paths for path in record_path)
+    cached_report_id = get_cached_report_id(report_type, marketplace_str, start_time, end_time,
+                                            default_report_options, covering)
     if cached_report_id:
         print(f"Using cached report ID: {cached_report_id}")
         report_id = cached_report_id
+        # A report that was downloaded before is served from its stored document without polling Amazon
+        document_hash = get_report_document('reports_cache.db', report_id)
     else:
         reports_api = ReportsV2(credentials=credentials, marketplace=marketplace)
-        report_id = request_report(reports_api, report_type, start_time, end_time)
-        save_report_cache(report_type, marketplace_str, start_time, end_time, record_path, report_id)
+        # end_time stays the canonical end of day for the cache key, but Amazon requires dataEndTime to not be
+        # in the future, so a range ending today is requested up to now
+        data_end_time = min(parser.parse(end_time), datetime.utcnow().replace(microsecond=0)).isoformat()
+        report_id = request_report(reports_api, report_type, start_time, data_end_time)
+        requested_at = monotonic()
+        save_report_cache(report_type, marketplace_str, start_time, end_time, record_path, default_report_options,
+                          report_id)
         print(f"Created new report ID: {report_id}")
+        document_hash = None
 
-    reports_api = ReportsV2(credentials=credentials, marketplace=marketplace)
-    document_id = check_report_status(reports_api, report_id)
-    if document_id:
-        content = download_report(reports_api, document_id)
-        data = json.loads(content)
-        print("HERE 1:{0}\n".format(data))
-        df = pd.json_normalize(data, record_path=record_path)
-        json_data = json.loads(df.to_json(orient='records'))
-        print("HERE 2:{0}".format(json_data))
-        return json_data
+    if not document_hash:
+        # Poll around the time similar reports took to complete; cached reports are checked right away
+        span_days = span_bucket(start_time, end_time)
+        expected_duration = get_expected_duration('reports_cache.db', report_type, 'DAY', span_days, marketplace_str)
+        delays = poll_delays(expected_duration, check_now=bool(cached_report_id))
+
+        reports_api = ReportsV2(credentials=credentials, marketplace=marketplace)
+        report = check_report_status(reports_api, report_id, delays)
+        if not report:
+            return None
+        if not cached_report_id:
+            duration = payload_duration(report, 'createdTime', 'processingEndTime')
+            if duration is None:
+                duration = monotonic() - requested_at
+            save_report_timing('reports_cache.db', report_type, 'DAY', span_days, marketplace_str, duration)
+        document_hash = download_report(reports_api, report['reportDocumentId'])
+        save_report_document('reports_cache.db', report_id, document_hash)
+
+    batches = normalize_document(document_hash, record_path)
+    if covering:
+        # Both dates are inclusive, end_time is the last second of the end day
+        start_date, end_date = start_time[:10], end_time[:10]
+        batches = ([row for row in batch if start_date <= row.get('date', start_date) <= end_date]
+                   for batch in batches)
+    return batches
 
 
 @app.route('/get-sp-report', methods=['GET'])
 def get_sp_report():
     report_type = request.args.get('reportType', 'GET_SALES_AND_TRAFFIC_REPORT')
     country_code = request.args.get('countryCode', 'US').upper()
-    marketplace = marketplaces.get(country_code, Marketplaces.FR)  # Default to FR if not found
+    marketplace = get_marketplace(country_code)  # Default to FR if not found
 
     try:
         start_time = parser.parse(request.args.get('startDate')) if 'startDate' in request.args else (
@@ -169,18 +250,25 @@ def get_sp_report():
     except ValueError as e:
         return jsonify({'status': 'error', 'message': 'Invalid date format. Please use YYYY-MM-DD format.'}), 400
 
-    if start_time >= end_time:
+    start_time, end_time = canonical_time(start_time), canonical_time(end_time)
+    if start_time > end_time:
         return jsonify({'status': 'error', 'message': 'The start date cannot be greater than the end date'}), 400
+    # End dates are inclusive: the cache key runs to the last second of the end day, the same day the row filter
+    # for covering reports keeps up to. Amazon is never asked for data past the current time
+    end_time = end_time + timedelta(days=1, seconds=-1)
 
-    record_path = request.args.get('recordPath', ['salesAndTrafficByAsin'])
+    record_path = canonical_record_path(request.args.get('recordPath', ['salesAndTrafficByAsin']))
+    output_format = request.args.get('format', 'json').lower()
+    if output_format not in RESPONSE_FORMATS:
+        return jsonify({'status': 'error', 'message': 'format must be json, ndjson or csv'}), 400
 
     try:
-        data = request_and_download_report(report_type, marketplace, start_time.isoformat(), end_time.isoformat(),
-                                           record_path)
-        return jsonify(data)
+        return report_response('get-sp-report', output_format, request_and_download_report, report_type, marketplace,
+                               start_time.isoformat(), end_time.isoformat(), record_path)
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
 if __name__ == '__main__':
+    create_app()
     app.run(debug=True, port=8000)
@@ -0,0 +1,43 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Cold start benchmark: time from interpreter launch to the first `/` response for each app.
+# Works with trees that have no create_app() factory, so older checkouts can be compared against this one, e.g.
+#   git worktree add /tmp/baseline <commit>
+#   python bench_startup.py --runs 10 /tmp/baseline .
+
+apps = ['SP_Api_Power_BI', 'SP_AD_Api_Power_BI']
+
+snippet = '''
+import {module} as module
+app = module.create_app() if hasattr(module, 'create_app') else module.app
+response = app.test_client().get('/')
+assert response.status_code == 200
+'''
+
+
+def time_cold_start(tree, module, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', snippet.format(module=module)], check=True, cwd=tree,
+                       stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Cold start to first / response')
+    arg_parser.add_argument('--runs', type=int, default=10)
+    arg_parser.add_argument('trees', nargs='*', default=[os.path.dirname(os.path.abspath(__file__))])
+    args = arg_parser.parse_args()
+
+    for tree in args.trees:
+        for module in apps:
+            timings = time_cold_start(os.path.abspath(tree), module, args.runs)
+            print(f"{tree} {module}: median {statistics.median(timings) * 1000:.1f} ms, "
+                  f"min {min(timings) * 1000:.1f} ms, max {max(timings) * 1000:.1f} ms over {args.runs} runs")
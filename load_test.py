@@ -0,0 +1,333 @@
+import argparse
+import enum
+import gzip
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Load and soak test for /get-ad-report against a local mocked Ads API.
+# Fires a mix of identical and distinct concurrent requests through the request_queue dedup path while the
+# process_request_queue worker runs, then reports latency, duplicate post_report calls, `database is locked`
+# errors from queries and commits, the queue depth during the run and how long the queue takes to drain after the
+# last request is submitted. Runs in a temporary directory with its own tokens.db.
+# Usage: python load_test.py --requests 200 --concurrency 20 --distinct 5 --rounds 3
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class MockAdsApi:
+    # Reports complete report_seconds after post_report, documents are served by a local HTTP server
+    def __init__(self, report_seconds):
+        self.report_seconds = report_seconds
+        self.lock = threading.Lock()
+        self.reports = {}
+        self.post_calls = Counter()
+        self.get_calls = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.document_handler())
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def document(self, report_id):
+        body = self.reports[report_id][1]
+        configuration = body['configuration']
+        rows = [{column: f'{column}-{i}' if column.endswith(('Asin', 'Sku')) else i
+                 for column in configuration['columns']} for i in range(100)]
+        return gzip.compress(json.dumps(rows).encode('utf-8'), mtime=0)
+
+    def document_handler(self):
+        api = self
+
+        class DocumentHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                report_id = self.path.strip('/')
+                if report_id not in api.reports:
+                    self.send_error(404)
+                    return
+                content = api.document(report_id)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return DocumentHandler
+
+    def reports_class(self):
+        api = self
+
+        class Reports:
+            def __init__(self, marketplace=None, credentials=None, access_token=None):
+                self.profile_id = credentials['profile_id']
+
+            def post_report(self, body):
+                report_id = str(uuid.uuid4())
+                key = (self.profile_id, body['startDate'], body['endDate'], body['configuration']['reportTypeId'],
+                       body['configuration']['timeUnit'])
+                with api.lock:
+                    api.reports[report_id] = (time.monotonic(), body)
+                    api.post_calls[key] += 1
+                return types.SimpleNamespace(payload={'reportId': report_id})
+
+            def get_report(self, reportId):
+                with api.lock:
+                    api.get_calls += 1
+                    created = api.reports[reportId][0]
+                completed = time.monotonic() - created >= api.report_seconds
+                return types.SimpleNamespace(payload={
+                    'reportId': reportId,
+                    'status': 'COMPLETED' if completed else 'PENDING',
+                    'url': f'{api.url}/{reportId}' if completed else None,
+                })
+
+        return Reports
+
+
+def install_mock_ad_api(api):
+    # Replaces the ad_api client modules, the app imports them inside the functions that use them
+    class AdvertisingApiException(Exception):
+        def __init__(self, code=500, error=None):
+            super().__init__(error)
+            self.code = code
+
+    ad_api = types.ModuleType('ad_api')
+    ad_api_api = types.ModuleType('ad_api.api')
+    ad_api_base = types.ModuleType('ad_api.base')
+    ad_api_api.Reports = api.reports_class()
+    ad_api_base.AdvertisingApiException = AdvertisingApiException
+    ad_api_base.Marketplaces = enum.Enum('Marketplaces', ['FR', 'DE', 'UK', 'US'])
+    ad_api.api, ad_api.base = ad_api_api, ad_api_base
+    sys.modules.update({'ad_api': ad_api, 'ad_api.api': ad_api_api, 'ad_api.base': ad_api_base})
+
+
+class LockStats:
+    # Counts `database is locked` errors raised by any query or commit the app, queue worker or caches run
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locked_errors = 0
+
+    def count(self, error):
+        if 'database is locked' in str(error):
+            with self.lock:
+                self.locked_errors += 1
+
+    def connect(self, *args, **kwargs):
+        stats = self
+
+        class CountingCursor(sqlite3.Cursor):
+            def execute(self, *args, **kwargs):
+                try:
+                    return super().execute(*args, **kwargs)
+                except sqlite3.OperationalError as e:
+                    stats.count(e)
+                    raise
+
+        class CountingConnection(sqlite3.Connection):
+            def cursor(self, factory=CountingCursor):
+                return super().cursor(factory)
+
+            def commit(self):
+                try:
+                    return super().commit()
+                except sqlite3.OperationalError as e:
+                    stats.count(e)
+                    raise
+
+        return sqlite3.connect(*args, factory=CountingConnection, **kwargs)
+
+    def module(self):
+        return types.SimpleNamespace(connect=self.connect, OperationalError=sqlite3.OperationalError)
+
+
+class QueueMonitor:
+    # Samples the request_queue depth in the background while the load runs, so the drain time is measured from
+    # the last submitted request with the others still in flight
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.samples = []
+        self.stop_event = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def depth(self):
+        conn = sqlite3.connect('tokens.db')
+        try:
+            return conn.execute(
+                "SELECT COUNT(*) FROM request_queue WHERE status IN ('pending', 'processing')").fetchone()[0]
+        finally:
+            conn.close()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.samples.append((time.perf_counter(), self.depth()))
+            except sqlite3.OperationalError:
+                pass  # Sampling is not part of the load, a busy database just skips this sample
+            self.stop_event.wait(self.interval)
+
+    def max_depth(self):
+        return max((depth for _, depth in self.samples), default=0)
+
+    def drain_time(self, since, timeout):
+        # Time from since until the queue was first seen empty
+        while True:
+            for sampled_at, depth in list(self.samples):
+                if sampled_at >= since and not depth:
+                    return sampled_at - since
+            if time.perf_counter() - since > timeout:
+                return None
+            time.sleep(self.interval)
+
+
+def request_variants(distinct):
+    # Distinct date ranges inside the retention period, each within one report
+    today = datetime.utcnow().date()
+    variants = []
+    for i in range(distinct):
+        end_date = today - timedelta(days=1 + i)
+        variants.append({
+            'reportType': 'spAdvertisedProduct',
+            'startDate': (end_date - timedelta(days=6)).isoformat(),
+            'endDate': end_date.isoformat(),
+            'timeUnit': 'SUMMARY',
+            'marketplace': 'FR',
+            'profileName': 'Load Test',
+        })
+    return variants
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run_round(app_module, variants, args):
+    # Returns the results and when the last request was submitted
+    submitted = []
+
+    def send(i):
+        client = app_module.app.test_client()
+        environ = {'REMOTE_ADDR': f'10.0.0.{i % args.user_ips + 1}'}
+        start = time.perf_counter()
+        submitted.append(start)
+        response = client.get('/get-ad-report', query_string=variants[i % len(variants)], environ_base=environ)
+        return time.perf_counter() - start, response.status_code, response.get_data(as_text=True)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(send, range(args.requests)))
+    return results, max(submitted)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Load and soak test for /get-ad-report')
+    arg_parser.add_argument('--requests', type=int, default=100, help='requests per round')
+    arg_parser.add_argument('--concurrency', type=int, default=20)
+    arg_parser.add_argument('--distinct', type=int, default=5, help='distinct date ranges, the rest are identical')
+    arg_parser.add_argument('--user-ips', type=int, default=3, help='client addresses the requests come from')
+    arg_parser.add_argument('--rounds', type=int, default=1, help='repeat the load to soak the caches and queue')
+    arg_parser.add_argument('--report-seconds', type=float, default=2, help='time the mock takes per report')
+    arg_parser.add_argument('--drain-timeout', type=float, default=120)
+    arg_parser.add_argument('--max-duplicate-posts', type=int, help='fail if more duplicate post_report calls')
+    arg_parser.add_argument('--max-locked-errors', type=int, help='fail if more `database is locked` errors')
+    arg_parser.add_argument('--max-p99', type=float, help='fail if the p99 latency in seconds is higher')
+    args = arg_parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    os.chdir(workdir)
+    os.environ['REPORT_SPOOL_DIR'] = os.path.join(workdir, 'spool')
+    os.environ['REPORT_DOCUMENT_DIR'] = os.path.join(workdir, 'documents')
+    sys.path.insert(0, REPO_DIR)
+
+    api = MockAdsApi(args.report_seconds)
+    api.start()
+    install_mock_ad_api(api)
+
+    import report_download
+    import report_polling
+    import SP_AD_Api_Power_BI as app_module
+
+    lock_stats = LockStats()
+    for module in (app_module, report_download, report_polling):
+        module.sqlite3 = lock_stats.module()
+    report_polling.DEFAULT_FIRST_DELAY = 0.5
+    report_polling.MIN_DELAY = 0.25
+
+    app_module.create_app()
+    app_module.get_credentials = lambda: {'access_token': 'token', 'client_id': 'client', 'client_secret': 'secret',
+                                          'refresh_token': 'refresh'}
+    app_module.save_profiles([{
+        'profileId': '1', 'countryCode': 'FR', 'currencyCode': 'EUR', 'dailyBudget': 0, 'timezone': 'Europe/Paris',
+        'accountInfo': {'id': 'A1', 'marketplaceStringId': 'A13V1IB3VIYZZH', 'name': 'Load Test'},
+    }])
+    threading.Thread(target=app_module.process_request_queue, daemon=True).start()
+    queue_monitor = QueueMonitor()
+    queue_monitor.start()
+
+    variants = request_variants(args.distinct)
+    results = []
+    load_start = time.perf_counter()
+    for round_number in range(args.rounds):
+        round_results, last_submitted = run_round(app_module, variants, args)
+        results.extend(round_results)
+        print(f"Round {round_number + 1}/{args.rounds}: {len(round_results)} requests")
+    load_time = time.perf_counter() - load_start
+    # Measured from the last request of the last round, the samples were taken while the requests were in flight
+    drain_time = queue_monitor.drain_time(last_submitted, args.drain_timeout)
+    queue_monitor.stop()
+    api.stop()
+
+    latencies = [latency for latency, _, _ in results]
+    errors = Counter(status for _, status, _ in results if status != 200)
+    locked_responses = sum('database is locked' in body for _, _, body in results)
+    duplicate_posts = sum(calls - 1 for calls in api.post_calls.values())
+    p99 = percentile(latencies, 0.99)
+
+    print(f"Requests: {len(results)} in {load_time:.1f} s ({len(results) / load_time:.1f} req/s), "
+          f"errors: {dict(errors) or 0}")
+    print(f"Latency: p50 {percentile(latencies, 0.5):.2f} s, p90 {percentile(latencies, 0.9):.2f} s, "
+          f"p99 {p99:.2f} s, max {max(latencies):.2f} s, mean {statistics.mean(latencies):.2f} s")
+    print(f"post_report calls: {sum(api.post_calls.values())} for {len(api.post_calls)} distinct reports "
+          f"({duplicate_posts} duplicates), get_report calls: {api.get_calls}")
+    print(f"database is locked: {lock_stats.locked_errors} errors, {locked_responses} failed responses")
+    print(f"Queue drain time after the last request: "
+          f"{f'{drain_time:.1f} s' if drain_time is not None else 'timed out'}, max queue depth: "
+          f"{queue_monitor.max_depth()}")
+    print(f"Working directory: {workdir}")
+
+    failures = []
+    if args.max_duplicate_posts is not None and duplicate_posts > args.max_duplicate_posts:
+        failures.append(f"{duplicate_posts} duplicate post_report calls > {args.max_duplicate_posts}")
+    if args.max_locked_errors is not None and lock_stats.locked_errors > args.max_locked_errors:
+        failures.append(f"{lock_stats.locked_errors} database is locked errors > {args.max_locked_errors}")
+    if args.max_p99 is not None and p99 > args.max_p99:
+        failures.append(f"p99 latency {p99:.2f} s > {args.max_p99} s")
+    if drain_time is None:
+        failures.append("request queue did not drain")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
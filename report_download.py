@@ -0,0 +1,208 @@
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import ijson
+import requests
+
+# Report documents are streamed to a spool file on disk instead of being held in memory, so several large
+# downloads finishing at the same time don't each need their full size in the worker's heap.
+SPOOL_DIR = os.environ.get('REPORT_SPOOL_DIR', 'spool')
+# Downloaded documents and their normalized rows are stored once under the SHA-256 of the decompressed document.
+# report_cache rows point at that hash, so identical documents behind different report IDs are parsed only once.
+DOCUMENT_DIR = os.environ.get('REPORT_DOCUMENT_DIR', 'documents')
+CHUNK_SIZE = 1024 * 1024
+# Rows are normalized and handed on in batches of this size
+BATCH_ROWS = 500
+MAX_RETRIES = 5
+# Seconds before the first retry of an interrupted download, doubled for each further attempt
+RETRY_DELAY = 1
+
+
+def spool_download(url, name):
+    # Partial downloads are kept as .part and resumed with a Range request if the connection drops.
+    # The spool name is unique to this call, so a download that is given up is removed rather than kept for resuming
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    path = os.path.join(SPOOL_DIR, name)
+    part_path = path + '.part'
+
+    try:
+        for attempt in range(MAX_RETRIES):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            try:
+                with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+                    if response.status_code == 416:
+                        # The part file already holds the whole document
+                        break
+                    response.raise_for_status()
+                    # A 200 means the server ignored the Range header, so start over
+                    mode = 'ab' if response.status_code == 206 else 'wb'
+                    with open(part_path, mode) as f:
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            f.write(chunk)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                print(f"Download of {name} interrupted ({e}), resuming (attempt {attempt + 1}/{MAX_RETRIES})")
+                if attempt + 1 < MAX_RETRIES:
+                    time.sleep(RETRY_DELAY * 2 ** attempt)
+        else:
+            raise ValueError(f"Failed to download report document {name} after {MAX_RETRIES} attempts")
+
+        os.replace(part_path, path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    return path
+
+
+def decompress_file(path, compressed):
+    # Decompress on disk in chunks; uncompressed documents are used as they are.
+    # The compressed file is removed either way, a failed decompression leaves no partial document behind
+    if not compressed:
+        return path
+    json_path = path + '.json'
+    try:
+        with gzip.open(path, 'rb') as src, open(json_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    except Exception:
+        if os.path.exists(json_path):
+            os.remove(json_path)
+        raise
+    finally:
+        os.remove(path)
+    return json_path
+
+
+def iter_json_items(path, prefix):
+    # Parse incrementally from a memory-mapped file: ijson reads the mapping in small buffers, so the raw document
+    # is never copied onto the heap, only the parsed items are. prefix is an ijson path, '' for the whole document.
+    if os.path.getsize(path) == 0:
+        raise ValueError(f"Report document {path} is empty")
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from ijson.items(mm, prefix, use_float=True)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_document(url, name, compressed=True):
+    # Concurrent requests may fetch the same document, so each download gets its own spool file
+    name = f"{name}-{os.getpid()}-{threading.get_ident()}"
+    path = decompress_file(spool_download(url, name), compressed)
+    try:
+        document_hash = file_sha256(path)
+        os.makedirs(DOCUMENT_DIR, exist_ok=True)
+        stored_path = document_path(document_hash)
+        if os.path.exists(stored_path):
+            print(f"Downloaded document is identical to stored document {document_hash}")
+        else:
+            os.replace(path, stored_path)
+    finally:
+        # The spool file is moved into the store, or dropped if it is a duplicate or storing it failed
+        if os.path.exists(path):
+            os.remove(path)
+    return document_hash
+
+
+def document_exists(document_hash):
+    return os.path.exists(document_path(document_hash))
+
+
+def document_path(document_hash):
+    return os.path.join(DOCUMENT_DIR, f'{document_hash}.json')
+
+
+def normalized_path(document_hash, variant):
+    # variant identifies how the document was normalized, e.g. the record path
+    variant_hash = hashlib.sha1(variant.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(DOCUMENT_DIR, f'{document_hash}.{variant_hash}.records.json')
+
+
+def iter_batches(items, size=BATCH_ROWS):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def record_prefix(record_path):
+    # ijson prefix of the records json_normalize(data, record_path=record_path) flattens, 'item' for a top level list.
+    # Like json_normalize, a string is a single key
+    if isinstance(record_path, str):
+        record_path = [record_path]
+    return '.item.'.join(record_path) + '.item' if record_path else 'item'
+
+
+def iter_normalized_batches(document_hash, variant, prefix, normalize_batch):
+    # Yields the normalized rows of a document in batches of BATCH_ROWS, so no caller needs every row at once.
+    # normalize_batch turns a list of records into a JSON array of rows. The first pass reads the records at prefix
+    # and writes the rows to the normalized file as they are produced; later passes read that file back.
+    path = normalized_path(document_hash, variant)
+    if os.path.exists(path):
+        yield from iter_batches(iter_json_items(path, 'item'))
+        return
+
+    # Written to a temporary file first so readers never see a partial file, it is dropped if the caller stops early
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('[')
+            separator = ''
+            for records in iter_batches(iter_json_items(document_path(document_hash), prefix)):
+                records_json = normalize_batch(records)
+                rows = json.loads(records_json)
+                if rows:
+                    f.write(separator + records_json[1:-1])
+                    separator = ','
+                yield rows
+            f.write(']')
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def add_document_hash_column(c):
+    # report_cache tables created before documents were content addressed have no document_hash column
+    columns = [row[1] for row in c.execute('PRAGMA table_info(report_cache)')]
+    if 'document_hash' not in columns:
+        c.execute('ALTER TABLE report_cache ADD COLUMN document_hash TEXT')
+
+
+def save_report_document(db_path, report_id, document_hash):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('UPDATE report_cache SET document_hash = ? WHERE report_id = ?', (document_hash, report_id))
+    conn.commit()
+    conn.close()
+
+
+def get_report_document(db_path, report_id):
+    # Hash of the stored document for a report, if it was downloaded before and is still on disk
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('''
+        SELECT document_hash FROM report_cache
+        WHERE report_id = ? AND document_hash IS NOT NULL
+        ORDER BY created_at DESC LIMIT 1
+    ''', (report_id,))
+    result = c.fetchone()
+    conn.close()
+    return result[0] if result and document_exists(result[0]) else None
@@ -0,0 +1,80 @@
+import math
+import random
+import sqlite3
+import statistics
+from dateutil import parser
+
+# Poll intervals are learned from how long earlier reports of the same kind took to complete. The first check is
+# scheduled just before the expected completion time, then follow-ups back off exponentially with jitter.
+DEFAULT_FIRST_DELAY = 5
+MIN_DELAY = 2
+MAX_DELAY = 60
+BACKOFF_FACTOR = 1.5
+JITTER = 0.2
+HISTORY_SIZE = 20
+
+
+def create_report_timings_table(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS report_timings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            report_type TEXT,
+            time_unit TEXT,
+            span_days INTEGER,
+            marketplace TEXT,
+            duration_seconds REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def span_bucket(start_date, end_date):
+    # Round the date span up to a power of two so similar ranges share their history
+    days = max((parser.parse(end_date) - parser.parse(start_date)).days, 1)
+    return 2 ** math.ceil(math.log2(days))
+
+
+def save_report_timing(db_path, report_type, time_unit, span_days, marketplace, duration_seconds):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('''
+        INSERT INTO report_timings (report_type, time_unit, span_days, marketplace, duration_seconds)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (report_type, time_unit, span_days, marketplace, duration_seconds))
+    conn.commit()
+    conn.close()
+
+
+def get_expected_duration(db_path, report_type, time_unit, span_days, marketplace):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('''
+        SELECT duration_seconds FROM report_timings
+        WHERE report_type = ? AND time_unit = ? AND span_days = ? AND marketplace = ?
+        ORDER BY created_at DESC LIMIT ?
+    ''', (report_type, time_unit, span_days, marketplace, HISTORY_SIZE))
+    durations = [row[0] for row in c.fetchall()]
+    conn.close()
+    return statistics.median(durations) if durations else None
+
+
+def payload_duration(payload, start_key, end_key):
+    # Completion time reported by Amazon, which is more accurate than what the poller observed
+    if not payload.get(start_key) or not payload.get(end_key):
+        return None
+    return (parser.parse(payload[end_key]) - parser.parse(payload[start_key])).total_seconds()
+
+
+def poll_delays(expected_duration, check_now=False):
+    # Yields how long to sleep before each status check; check_now skips the first wait, e.g. for cached reports
+    if check_now:
+        yield 0
+    elif expected_duration is None:
+        yield DEFAULT_FIRST_DELAY
+    else:
+        yield max(expected_duration * 0.9, MIN_DELAY)
+
+    delay = min(max(MIN_DELAY, (expected_duration or DEFAULT_FIRST_DELAY) * 0.25), MAX_DELAY)
+    while True:
+        yield delay * random.uniform(1 - JITTER, 1 + JITTER)
+        delay = min(delay * BACKOFF_FACTOR, MAX_DELAY)
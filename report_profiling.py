@@ -0,0 +1,111 @@
+import cProfile
+import io
+import os
+import pstats
+import threading
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from flask import Blueprint, abort, jsonify, request, send_from_directory
+
+# Opt-in profiling of single requests. A request is profiled when its X-Profile-Token header matches the
+# PROFILING_TOKEN environment variable, or for every request and queue job while the admin switch is on.
+# Each profile is saved to PROFILE_DIR as a cProfile dump, a tracemalloc snapshot and a text summary.
+# cProfile only sees the thread it was started in, so work done in chunk worker threads is not included.
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_FILES = {'summary': '{}.txt', 'cprofile': '{}.prof', 'tracemalloc': '{}.snapshot'}
+TOP_ENTRIES = 30
+
+profiling_switch = {'enabled': False}
+# tracemalloc is process wide, so only one request is profiled at a time
+profiling_lock = threading.Lock()
+
+profiling_blueprint = Blueprint('profiling', __name__)
+
+
+def is_authorized(headers):
+    token = os.environ.get('PROFILING_TOKEN')
+    return bool(token) and headers.get('X-Profile-Token') == token
+
+
+def profiling_requested(headers=None):
+    return profiling_switch['enabled'] or (headers is not None and is_authorized(headers))
+
+
+class RequestProfile:
+    def __init__(self):
+        self.id = None
+
+
+def save_profile(profile_id, profiler, snapshot):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler.dump_stats(os.path.join(PROFILE_DIR, PROFILE_FILES['cprofile'].format(profile_id)))
+    snapshot.dump(os.path.join(PROFILE_DIR, PROFILE_FILES['tracemalloc'].format(profile_id)))
+
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(TOP_ENTRIES)
+    summary.write(f"Top {TOP_ENTRIES} allocations by line:\n")
+    for stat in snapshot.statistics('lineno')[:TOP_ENTRIES]:
+        summary.write(f"{stat}\n")
+    with open(os.path.join(PROFILE_DIR, PROFILE_FILES['summary'].format(profile_id)), 'w') as f:
+        f.write(summary.getvalue())
+
+
+@contextmanager
+def profile_request(name, enabled):
+    profile = RequestProfile()
+    if not enabled or not profiling_lock.acquire(blocking=False):
+        if enabled:
+            print(f"Skipping profile of {name}, another request is being profiled")
+        yield profile
+        return
+
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profile
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracemalloc:
+            tracemalloc.stop()
+        profile.id = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}"
+        try:
+            save_profile(profile.id, profiler, snapshot)
+            print(f"Saved profile {profile.id}")
+        finally:
+            profiling_lock.release()
+
+
+def profiled_json_response(name, func, *args):
+    # Runs func and serializes its result, profiled if the current request asks for it
+    with profile_request(name, profiling_requested(request.headers)) as profile:
+        response = jsonify(func(*args))
+    if profile.id:
+        response.headers['X-Profile-Id'] = profile.id
+    return response
+
+
+@profiling_blueprint.route('/admin/profiling', methods=['GET', 'POST'])
+def profiling_admin():
+    if not is_authorized(request.headers):
+        abort(403)
+    if request.method == 'POST':
+        profiling_switch['enabled'] = request.args.get('enabled', '0').lower() in ('1', 'true', 'yes')
+    profiles = sorted(name[:-len('.txt')] for name in os.listdir(PROFILE_DIR) if name.endswith('.txt')) \
+        if os.path.isdir(PROFILE_DIR) else []
+    return jsonify({'enabled': profiling_switch['enabled'], 'profiles': profiles})
+
+
+@profiling_blueprint.route('/admin/profiling/<profile_id>/<kind>', methods=['GET'])
+def get_profile(profile_id, kind):
+    if not is_authorized(request.headers):
+        abort(403)
+    if kind not in PROFILE_FILES:
+        abort(404)
+    return send_from_directory(os.path.abspath(PROFILE_DIR), PROFILE_FILES[kind].format(profile_id),
+                               as_attachment=kind != 'summary')
@@ -0,0 +1,69 @@
+import csv
+import io
+import json
+from itertools import chain
+from flask import Response, request, stream_with_context
+from report_profiling import profile_request, profiled_json_response, profiling_requested
+
+# format=ndjson and format=csv write the report rows to the response batch by batch as it is sent, instead of
+# serializing the whole body up front like jsonify. The report functions return their rows as a generator of
+# batches that normalizes the document as it goes, so clients start ingesting right away and the server never
+# holds all the rows or the complete serialized body.
+STREAM_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+RESPONSE_FORMATS = ('json',) + tuple(STREAM_FORMATS)
+
+
+def ndjson_lines(batches):
+    for batch in batches:
+        if batch:
+            yield ''.join(json.dumps(row) + '\n' for row in batch)
+
+
+def csv_lines(batches, columns=None):
+    # The header is written before the rows, so it uses the known columns of the report when there are some.
+    # Otherwise it is taken from the first row: batches are normalized separately, so a nested field missing from
+    # every record of the first batch only becomes a column later. Such a row stops the stream with an error rather
+    # than losing its values; format=ndjson has no header and is not affected.
+    buf = io.StringIO()
+    writer = None
+    header = None
+    for batch in batches:
+        for row in batch:
+            if writer is None:
+                writer = csv.DictWriter(buf, fieldnames=columns or list(row), extrasaction='ignore')
+                writer.writeheader()
+                header = None if columns else set(writer.fieldnames)
+            if header is not None and not header.issuperset(row):
+                raise ValueError(f"Columns {sorted(set(row) - header)} are not in the CSV header, "
+                                 f"request format=ndjson instead")
+            writer.writerow(row)
+        if buf.tell():
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+
+def streamed_response(batches, output_format, columns=None):
+    lines = ndjson_lines(batches) if output_format == 'ndjson' else csv_lines(batches, columns)
+    return Response(stream_with_context(lines), mimetype=STREAM_FORMATS[output_format])
+
+
+def report_rows(func, *args):
+    # Collects the batches func returns into one list, None if the report didn't complete
+    batches = func(*args)
+    return None if batches is None else [row for batch in batches for row in batch]
+
+
+def report_response(name, output_format, func, *args, columns=None):
+    # func returns the report rows as a generator of batches. json collects them into one response, ndjson and csv
+    # stream them, columns is the CSV header if the report's columns are known up front. The report is fetched and its first batch normalized before the response is returned, so those
+    # errors still come back as an error response; profiling covers that part, not the rest of the stream.
+    if output_format not in STREAM_FORMATS:
+        return profiled_json_response(name, report_rows, func, *args)
+    with profile_request(name, profiling_requested(request.headers)) as profile:
+        batches = iter(func(*args) or ())
+        first_batch = next(batches, [])
+    response = streamed_response(chain([first_batch], batches), output_format, columns)
+    if profile.id:
+        response.headers['X-Profile-Id'] = profile.id
+    return response